@@ -6,6 +6,8 @@ Known format that work:
     - ply, stl, obj
 With color? 
     - ply
+Instancing (one box per detector type, plus a transformation per detector):
+    - gltf, glb, when no per-detector colors are requested
 
 3D viewer tried:
     meshlab: Work with color 
@@ -35,6 +37,30 @@ import argparse
 #########################################################################################
 crystal_color = np.array([255, 40, 40], dtype=np.uint8)
 
+# Random generator for --random-color
+_rng = np.random.default_rng()
+
+# Faces of a box, using the indices of the 8 vertices that make up each face.
+# Geometry handed to trimesh is kept as C-contiguous float64 vertices and int64 faces,
+# the types it uses internally, to avoid hidden conversions and copies.
+_BOX_FACES = np.array(
+    [
+        [1, 0, 2],
+        [0, 2, 3],  # Bottom face
+        [4, 5, 6],
+        [4, 6, 7],  # Top face
+        [0, 3, 7],
+        [0, 7, 4],  # Left face
+        [1, 2, 6],
+        [1, 6, 5],  # Right face
+        [0, 1, 5],
+        [0, 5, 4],  # Front face
+        [3, 2, 6],
+        [3, 6, 7],  # Back face
+    ],
+    dtype=np.int64,
+)
+
 
 #########################################################################################
 # Methods
@@ -45,87 +71,89 @@ def transform_to_mat44(
     return np.vstack([transform.matrix, [0, 0, 0, 1]])
 
 
-def mat44_to_transform(mat: npt.NDArray[np.float32]) -> petsird.RigidTransformation:
-    return petsird.RigidTransformation(matrix=mat[0:3, :])
-
-
-def coordinate_to_homogeneous(coord: petsird.Coordinate) -> npt.NDArray[np.float32]:
-    return np.hstack([coord.c, 1])
-
-
-def homogeneous_to_coordinate(
-    hom_coord: npt.NDArray[np.float32],
-) -> petsird.Coordinate:
-    return petsird.Coordinate(c=hom_coord[0:3])
-
-
-def mult_transforms(
+def transforms_to_mat44(
     transforms: list[petsird.RigidTransformation],
-) -> petsird.RigidTransformation:
-    """multiply rigid transformations"""
-    mat = np.array(
-        ((1, 0, 0, 0), (0, 1, 0, 0), (0, 0, 1, 0), (0, 0, 0, 1)),
-        dtype="float32",
+) -> npt.NDArray[np.float64]:
+    """stack rigid transformations as an (N, 4, 4) array"""
+    return np.ascontiguousarray(
+        np.stack([transform_to_mat44(t) for t in transforms]), dtype=np.float64
     )
 
-    for t in reversed(transforms):
-        mat = np.matmul(transform_to_mat44(t), mat)
-    return mat44_to_transform(mat)
-
 
-def mult_transforms_coord(
-    transforms: list[petsird.RigidTransformation], coord: petsird.Coordinate
-) -> petsird.Coordinate:
-    """apply list of transformations to coordinate"""
-    # TODO better to multiply with coordinates in sequence, as first multiplying the matrices
-    hom = np.matmul(
-        transform_to_mat44(mult_transforms(transforms)),
-        coordinate_to_homogeneous(coord),
-    )
-    return homogeneous_to_coordinate(hom)
+def box_shape_to_array(box_shape: petsird.BoxShape) -> npt.NDArray[np.float64]:
+    """corners of a BoxShape as an (8, 3) array"""
+    return np.array([c.c for c in box_shape.corners], dtype=np.float64)
 
 
-def transform_BoxShape(
-    transform: petsird.RigidTransformation, box_shape: petsird.BoxShape
-) -> petsird.BoxShape:
-    return petsird.BoxShape(
-        corners=[mult_transforms_coord([transform], c) for c in box_shape.corners]
+def create_box_from_vertices(vertices):
+    # vertices holds 8 consecutive corners per box, possibly for many boxes
+    vertices = np.ascontiguousarray(vertices, dtype=np.float64).reshape((-1, 3))
+    num_boxes = len(vertices) // 8
+    faces = (
+        _BOX_FACES[None, :, :] + (np.arange(num_boxes, dtype=np.int64) * 8)[:, None, None]
+    ).reshape((-1, 3))
+    # Create and return a single Trimesh object, skipping trimesh's merge/validation steps
+    return trimesh.Trimesh(
+        vertices=vertices,
+        faces=faces,
+        process=False,
+        validate=False,
     )
 
 
-def create_box_from_vertices(vertices):
-    # Define faces using the indices of vertices that make up each face
-    faces = [
-        [1, 0, 2],
-        [0, 2, 3],  # Bottom face
-        [4, 5, 6],
-        [4, 6, 7],  # Top face
-        [0, 3, 7],
-        [0, 7, 4],  # Left face
-        [1, 2, 6],
-        [1, 6, 5],  # Right face
-        [0, 1, 5],
-        [0, 5, 4],  # Front face
-        [3, 2, 6],
-        [3, 6, 7],  # Back face
-    ]
-
-    # Create and return a Trimesh object
-    box = trimesh.Trimesh(vertices=vertices, faces=faces)
+def add_box_instances(scene, name, local_corners, mats, face_color):
+    """add a single box to the scene, instanced at each of the (N, 4, 4) transformations"""
+    box = create_box_from_vertices(local_corners)
+    box.visual.face_colors = face_color
+    scene.add_geometry(box, geom_name=name, node_name=f"{name}_0", transform=mats[0])
+    for i in range(1, len(mats)):
+        scene.graph.update(frame_to=f"{name}_{i}", matrix=mats[i], geometry=name)
+
+
+def write_binary_ply(fname, vertices, faces, face_colors):
+    """write a triangle mesh with RGBA face colors as binary PLY, without going through trimesh"""
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        f"element vertex {len(vertices)}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        f"element face {len(faces)}\n"
+        "property list uchar int vertex_indices\n"
+        "property uchar red\n"
+        "property uchar green\n"
+        "property uchar blue\n"
+        "property uchar alpha\n"
+        "end_header\n"
+    )
+    # PLY stores faces record by record: count, indices, color
+    face_records = np.empty(
+        len(faces), dtype=[("count", "u1"), ("indices", "<i4", (3,)), ("rgba", "u1", (4,))]
+    )
+    face_records["count"] = 3
+    face_records["indices"] = faces
+    face_records["rgba"] = face_colors
 
-    return box
+    with open(fname, "wb") as f:
+        f.write(header.encode("ascii"))
+        f.write(memoryview(np.ascontiguousarray(vertices, dtype="<f4")))
+        f.write(memoryview(face_records.view(np.uint8)))
 
 
 def extract_detector_eff(show_det_eff, header):
     if header.scanner.detection_efficiencies.det_el_efficiencies is not None:
         if show_det_eff == True:
-            detector_efficiencies = header.scanner.detection_efficiencies.det_el_efficiencies
+            # For viewing purporse, we simply get the mean of detector efficiency energy-wise
+            detector_efficiencies = np.mean(
+                header.scanner.detection_efficiencies.det_el_efficiencies, axis=1
+            )
         else:
+            # The mean of all ones is one, no need to build the full array
             detector_efficiencies = np.ones(
-                header.scanner.detection_efficiencies.det_el_efficiencies.shape
+                header.scanner.detection_efficiencies.det_el_efficiencies.shape[0],
+                dtype=np.float32,
             )
-            # For viewing purporse, we simply get the mean of detector efficiency energy-wise
-        detector_efficiencies = np.mean(detector_efficiencies, axis=1)
     elif (
         header.scanner.detection_efficiencies.det_el_efficiencies is None
         and show_det_eff == True
@@ -138,44 +166,201 @@ def extract_detector_eff(show_det_eff, header):
     return detector_efficiencies
 
     
-def set_detector_color(det_mesh, detector_efficiencies, mod_i, num_det_in_module, det_i, random_color):
+def _rgba(rgb: npt.ArrayLike) -> npt.NDArray[np.uint8]:
+    """append the (fixed) alpha to an (N, 3) array of colors"""
+    colors = np.empty((len(rgb), 4), dtype=np.uint8)
+    colors[:, :3] = rgb
+    colors[:, 3] = 50
+    return colors
+
+
+# Color functions. All return the RGBA colors of num shapes as a (num, 4) array,
+# efficiencies being the (num,) efficiencies of the shapes, or None if not known.
+def random_colors(num, efficiencies) -> npt.NDArray[np.uint8]:
+    # A single draw for all shapes
+    return _rgba(_rng.integers(0, 255, size=(num, 3), dtype=np.uint8))
+
+
+def efficiency_colors(num, efficiencies) -> npt.NDArray[np.uint8]:
+    # Fixed-point (8 fractional bits) scaling. Efficiencies are clipped to [0, 1] first
+    # (NaN counting as 0), such that the result cannot exceed crystal_color or wrap around.
+    scale = (np.clip(np.nan_to_num(efficiencies), 0, 1) * 256).astype(np.uint32)
+    return _rgba((crystal_color[None, :].astype(np.uint32) * scale[:, None]) >> 8)
+
+
+def constant_colors(num, efficiencies) -> npt.NDArray[np.uint8]:
+    return _rgba(np.broadcast_to(crystal_color, (num, 3)))
+
+
+def select_color_fn(detector_efficiencies, random_color, show_det_eff):
+    """pick the color function once, such that no branching is needed per shape"""
     if random_color == True:
-        color = np.random.randint(0, 255, size=3)
-    elif detector_efficiencies is not None:
-        color = (crystal_color * detector_efficiencies[mod_i * num_det_in_module + det_i])
+        return random_colors
+    elif show_det_eff == True and detector_efficiencies is not None:
+        return efficiency_colors
     else:
-        color = crystal_color
-    
-    f_color = np.array([color[0], color[1], color[2], 50]).astype(
-        np.uint8
-    )
+        return constant_colors
 
-    det_mesh.visual.face_colors = f_color
 
-    return det_mesh
+def _next_pow2(size: int) -> int:
+    return 1 << max(size - 1, 0).bit_length()
 
 
+def _capacity(current: int, size: int) -> int:
+    """size for a first allocation, rounded up to a power of 2 when growing"""
+    return size if current == 0 else _next_pow2(size)
 
-def set_module_color(
-    module_mesh, detector_efficiencies, mod_i, num_det_in_module, det_el, random_color
-):
-    if random_color == True:
-        color = np.random.randint(0, 255, size=3)
-    elif detector_efficiencies is not None:
-        # Mean of the detector efficiency in the current module
-        color = crystal_color * np.mean(
-            detector_efficiencies.reshape((-1, len(det_el) * num_det_in_module))[
-                mod_i, :
-            ]
+
+def _reserve(buf: npt.NDArray, size: int) -> npt.NDArray:
+    """buf if it holds at least size elements, otherwise a larger buffer"""
+    if buf.size >= size:
+        return buf
+    return np.empty(_capacity(buf.size, size), dtype=buf.dtype)
+
+
+def build_instanced_scene(scanner_geometry, face_color) -> trimesh.Scene:
+    """scene with a single box per detector type, instanced at every detector"""
+    scene = trimesh.Scene()
+    for rep_module_i, rep_module in enumerate(scanner_geometry.replicated_modules):
+        mod_mats = transforms_to_mat44(rep_module.transforms)  # (M, 4, 4)
+        for rep_volume_i, rep_volume in enumerate(rep_module.object.detecting_elements):
+            det_mats = transforms_to_mat44(rep_volume.transforms)  # (D, 4, 4)
+            add_box_instances(
+                scene,
+                f"detector_{rep_module_i}_{rep_volume_i}",
+                box_shape_to_array(rep_volume.object.shape),
+                np.einsum("mij,djk->mdik", mod_mats, det_mats).reshape((-1, 4, 4)),
+                face_color,
+            )
+    return scene
+
+
+class GeometryBuilder:
+    """
+    Builds the meshes of all detectors (or modules) of a scanner geometry.
+
+    The composite transformation, vertex and face buffers are kept between calls to
+    build. They are allocated with the exact size first, and only reallocated (to the
+    next power of 2) when a later call needs more room. Reuse only helps when the same
+    builder is used for several geometries; the script itself builds a single one.
+    The returned meshes use these buffers, so they are only valid until the next call
+    to build.
+    """
+
+    def __init__(self):
+        self._composite = np.empty(0, dtype=np.float64)
+        self._verts_out = np.empty(0, dtype=np.float64)
+        self._faces_out = np.empty((0, 3), dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        """start a new geometry, keeping the allocated buffers"""
+        self._det_k = 0  # index of the next detector to write
+
+    def _transform_boxes(self, mod_mats, det_mats, local_corners, out):
+        """write the world corners of all module x detector boxes into out (M, D, 8, 3)"""
+        shape = (len(mod_mats), len(det_mats), 4, 4)
+        size = int(np.prod(shape))
+        self._composite = _reserve(self._composite, size)
+        composite = self._composite[:size].reshape(shape)
+        np.matmul(mod_mats[:, None], det_mats[None, :], out=composite)
+        # Rotation and translation written into out directly, without temporaries
+        np.matmul(local_corners, composite[..., :3, :3].swapaxes(-1, -2), out=out)
+        out += composite[..., None, :3, 3]
+
+    def _box_faces(self, num_boxes):
+        """faces of num_boxes boxes stored consecutively, 8 vertices each"""
+        # Faces of fewer boxes are a prefix of these, so only recompute when growing
+        if len(self._faces_out) < num_boxes * len(_BOX_FACES):
+            capacity = _capacity(len(self._faces_out) // len(_BOX_FACES), num_boxes)
+            self._faces_out = (
+                _BOX_FACES[None, :, :]
+                + (np.arange(capacity, dtype=np.int64) * 8)[:, None, None]
+            ).reshape((-1, 3))
+        return self._faces_out[: num_boxes * len(_BOX_FACES)]
+
+    def build(
+        self, scanner_geometry, detector_efficiencies, color_fn, modules_only
+    ) -> list[trimesh.Trimesh]:
+        """single mesh with all detectors, or one convex hull per module if modules_only"""
+        self.reset()
+        rep_modules = scanner_geometry.replicated_modules
+        num_det = sum(
+            len(rep_module.transforms)
+            * sum(
+                len(rep_volume.transforms)
+                for rep_volume in rep_module.object.detecting_elements
+            )
+            for rep_module in rep_modules
         )
-    else:
-        color = crystal_color
+        # All detector boxes go in one vertex buffer, 8 corners per detector
+        self._verts_out = _reserve(self._verts_out, num_det * 8 * 3)
+        all_verts = self._verts_out[: num_det * 8 * 3].reshape((-1, 3))
 
-    f_color = np.array([color[0], color[1], color[2], 50]).astype(np.uint8)
+        shapes = []
+        # draw all crystals
+        for rep_module in rep_modules:
+            det_el = (
+                rep_module.object.detecting_elements
+            )  # Get all the detecting elements modules
+            # Matrices are converted once here, not per detector or corner
+            mod_mats = transforms_to_mat44(rep_module.transforms)  # (M, 4, 4)
+            num_modules = len(mod_mats)
+            num_det_per_module = sum(len(rep_volume.transforms) for rep_volume in det_el)
+            # View on the vertex buffer: detectors of each module are consecutive
+            start = self._det_k
+            module_corners = all_verts[
+                start * 8 : (start + num_modules * num_det_per_module) * 8
+            ].reshape((num_modules, num_det_per_module, 8, 3))
+            self._det_k += num_modules * num_det_per_module
+
+            det_offset = 0
+            for rep_volume in det_el:
+                det_mats = transforms_to_mat44(rep_volume.transforms)  # (D, 4, 4)
+                # Same local box for all detectors of this type
+                local_corners = box_shape_to_array(rep_volume.object.shape)  # (8, 3)
+                self._transform_boxes(
+                    mod_mats,
+                    det_mats,
+                    local_corners,
+                    module_corners[:, det_offset : det_offset + len(det_mats)],
+                )
+                det_offset += len(det_mats)
+
+            if modules_only:
+                if detector_efficiencies is not None:
+                    # Mean of the detector efficiency in each module
+                    module_efficiencies = (
+                        detector_efficiencies[
+                            start : start + num_modules * num_det_per_module
+                        ]
+                        .reshape((num_modules, -1))
+                        .mean(axis=1)
+                    )
+                else:
+                    module_efficiencies = None
+                module_colors = color_fn(num_modules, module_efficiencies)
+
+                for mod_i in range(num_modules):
+                    module_mesh = trimesh.convex.convex_hull(
+                        module_corners[mod_i].reshape((-1, 3))
+                    )
+                    module_mesh.visual.face_colors = module_colors[mod_i]
 
-    module_mesh.visual.face_colors = f_color
+                    shapes.append(module_mesh)
 
-    return module_mesh
+        if not modules_only:
+            det_mesh = trimesh.Trimesh(
+                vertices=all_verts,
+                faces=self._box_faces(num_det),
+                process=False,
+                validate=False,
+            )
+            all_colors = color_fn(num_det, detector_efficiencies)
+            det_mesh.visual.face_colors = np.repeat(all_colors, len(_BOX_FACES), axis=0)
+            shapes.append(det_mesh)
+
+        return shapes
 
 
 #########################################################################################
@@ -246,61 +431,61 @@ if __name__ == "__main__":
     output_fname = args.output
     modules_only = args.modules_only
 
-    with petsird.BinaryPETSIRDReader(file) as reader:
-        header = reader.read_header()
-
-        # Forced to do this
-        for time_block in reader.read_time_blocks():
+    # Only the header is needed for the geometry, so the (potentially huge) time
+    # blocks are not decoded. The reader's close() raises when the time blocks were not
+    # consumed, hence the reader is not used as a context manager and we close the
+    # input file ourselves.
+    reader = petsird.BinaryPETSIRDReader(file)
+    header = reader.read_header()
+    if args.input is not None:
+        file.close()
+    else:
+        # Drain the rest of stdin as raw bytes, such that a producer piping into us
+        # does not get a broken pipe
+        while file.read(1 << 20):
             pass
 
-        detector_efficiencies = extract_detector_eff(args.show_det_eff, header)
+    detector_efficiencies = extract_detector_eff(args.show_det_eff, header)
+    color_fn = select_color_fn(
+        detector_efficiencies, args.random_color, args.show_det_eff
+    )
 
+    # glTF supports instancing, in which case a single box per detector type is stored,
+    # with one transformation per detector. All instances share the box color.
+    instanced = (
+        not modules_only
+        and color_fn is constant_colors
+        and os.path.splitext(output_fname)[1].lower() in (".gltf", ".glb")
+    )
+    if instanced:
+        scene = build_instanced_scene(
+            header.scanner.scanner_geometry, color_fn(1, None)[0]
+        )
         shapes = []
-        # draw all crystals
-        for rep_module in header.scanner.scanner_geometry.replicated_modules:
-            det_el = (
-                rep_module.object.detecting_elements
-            )  # Get all the detecting elements modules
-            for mod_i in range(len(rep_module.transforms)):
-                vertices = []  # If showing modules only
-                mod_transform = rep_module.transforms[mod_i]
-                for rep_volume in det_el:
-                    num_det_in_module = len(rep_volume.transforms)
-                    for det_i in range(num_det_in_module):
-                        transform = rep_volume.transforms[det_i]
-                        box: petsird.BoxShape = transform_BoxShape(
-                            mult_transforms([mod_transform, transform]),
-                            rep_volume.object.shape,
-                        )
-                        corners = []
-                        for boxcorner in box.corners:
-                            corners.append(boxcorner.c)
-
-                        if not modules_only:
-                            det_mesh = create_box_from_vertices(corners)
-
-                            det_mesh = set_detector_color(det_mesh, detector_efficiencies, mod_i, num_det_in_module, det_i, args.random_color)
-
-                            shapes.append(det_mesh)
-                        else:
-                            vertices.append(corners)
-                if modules_only:
-                    vertices_reshaped = np.array(vertices).reshape((-1, 3))
-                    module_mesh = trimesh.convex.convex_hull(vertices_reshaped)
-
-                    module_mesh = set_module_color(
-                            module_mesh,
-                            detector_efficiencies,
-                            mod_i,
-                            num_det_in_module,
-                            det_el, args.random_color
-                        )
-
-                    shapes.append(module_mesh)
+    else:
+        shapes = GeometryBuilder().build(
+            header.scanner.scanner_geometry,
+            detector_efficiencies,
+            color_fn,
+            modules_only,
+        )
 
-        if args.fov is not None:
-            shapes.append(
-                trimesh.creation.cylinder(radius=args.fov[0], height=args.fov[1])
+    if args.fov is not None:
+        shapes.append(
+            trimesh.creation.cylinder(radius=args.fov[0], height=args.fov[1])
+        )
+    if instanced:
+        for shape in shapes:
+            scene.add_geometry(shape)
+        scene.export(output_fname)
+    else:
+        combined = shapes[0] if len(shapes) == 1 else trimesh.util.concatenate(shapes)
+        if os.path.splitext(output_fname)[1].lower() == ".ply":
+            write_binary_ply(
+                output_fname,
+                combined.vertices,
+                combined.faces,
+                combined.visual.face_colors,
             )
-        combined = trimesh.util.concatenate(shapes)
-        combined.export(output_fname)
+        else:
+            combined.export(output_fname)